@@ -1,29 +1,48 @@
 import typer
-import uuid
+import functools
+import hashlib
+import heapq
 import shutil
-from urllib.parse import urlparse
-import yaml
 import json
-import psutil
-import questionary
 import os
 import re
 import subprocess
-import pyaml
+import time
+import warnings
 import pathlib
 from cllama.spec import GPU_MEMORY
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    # bento info comes from arbitrary YAML, which may have non-str keys
+    _json_dumps = functools.partial(
+        orjson.dumps,
+        default=str,
+        option=orjson.OPT_NON_STR_KEYS,
+    )
+
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(data):
+        return json.dumps(data, default=str).encode()
+
 
 HOME_DIR = pathlib.Path.home()
 CLLAMA_HOME = HOME_DIR / ".cllama"
 BENTOML_HOME = CLLAMA_HOME / "bentoml"
 REPO_DIR = CLLAMA_HOME / "repos"
 CACHE_DIR = CLLAMA_HOME / "cache"
+BENTO_INFO_CACHE_FILE = CACHE_DIR / "bento_info.json"
 
 CLLAMA_HOME.mkdir(exist_ok=True, parents=True)
 CACHE_DIR.mkdir(exist_ok=True, parents=True)
 REPO_DIR.mkdir(exist_ok=True, parents=True)
 
+BENTOML_ENV = {**os.environ, "BENTOML_HOME": str(BENTOML_HOME)}
+
 
 app = typer.Typer()
 
@@ -63,29 +82,28 @@ MODEL_INFOS = {
 
 
 # match repo, branch, subdirectory
-REG_GITPACKAGE = r"git\+(?P<repo>.+?)@(?P<branch>.+?)#subdirectory=(?P<subdirectory>.+)"
+REG_GITPACKAGE = r"git\+(?P<repo>[^@]+)@(?P<branch>[^#]+)#subdirectory=(?P<subdirectory>\S+)"
 REG_GITPACKAGE = re.compile(REG_GITPACKAGE)
 
+# only NVIDIA GPU instance types are fetched; GPU count and memory are matched
+# locally so the cached catalog serves every model
+GPU_INSTANCE_TYPE_FILTERS = [
+    {"Name": "gpu-info.gpus.manufacturer", "Values": ["NVIDIA"]},
+]
+
 
 @app.command()
 def serve():
     pass
 
 
-def _cli_install_aws():
-    if subprocess.check_call(["which", "aws"]) != 0:
-        print("aws cli is not installed")
-    else:
-        print("aws cli is not configured")
-    return
-
-
 def _filter_instance_types(
     instance_types,
     gpu_count,
     gpu_memory=None,
     gpu_type=None,
     level="match",
+    limit=50,
 ):
     if gpu_memory is None:
         if gpu_type is None:
@@ -118,27 +136,115 @@ def _filter_instance_types(
                 return False
 
     def _sort_key(spec):
+        gpus = spec.get("GpuInfo", {}).get("Gpus")
         return (
             spec["InstanceType"].split(".")[0],
-            spec.get("GpuInfo", {}).get("Gpus", [{}])[0].get("Count", 0),
+            gpus[0].get("Count", 0) if gpus else 0,
             spec.get("VCpuInfo", {}).get("DefaultVCpus", 0),
             spec.get("MemoryInfo", {}).get("SizeInMiB", 0),
         )
 
-    return sorted(filter(_check_instance, instance_types), key=_sort_key)
+    return heapq.nsmallest(
+        limit,
+        filter(_check_instance, instance_types),
+        key=_sort_key,
+    )
+
+
+@functools.cache
+def _ec2_client(region=None):
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        "ec2",
+        region_name=region,
+        config=Config(
+            retries={"max_attempts": 5, "mode": "adaptive"},
+            max_pool_connections=10,
+        ),
+    )
+
+
+def _describe_instance_types(filters=None):
+    paginator = _ec2_client().get_paginator("describe_instance_types")
+    pages = paginator.paginate(
+        Filters=filters or [],
+        PaginationConfig={"PageSize": 100},
+    )
+    return [it_info for page in pages for it_info in page["InstanceTypes"]]
+
+
+def _dump_json_atomic(path, data):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(_json_dumps(data))
+    os.replace(tmp_path, path)
+
 
+def _load_cached_instance_types(region, ttl=86400, refresh=False):
+    cache_file = CACHE_DIR / f"ec2_it_{region}.json"
+    if not refresh:
+        try:
+            if time.time() - cache_file.stat().st_mtime < ttl:
+                return _json_loads(cache_file.read_bytes())
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    it_infos = _describe_instance_types(GPU_INSTANCE_TYPE_FILTERS)
+    _dump_json_atomic(cache_file, it_infos)
+    return it_infos
+
+
+@functools.cache
+def _load_bento_info_cache():
+    try:
+        return _json_loads(BENTO_INFO_CACHE_FILE.read_bytes())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _list_all_bentos():
+    cmd = ["bentoml", "list", "-o", "json"]
+    list_result = subprocess.check_output(cmd, env=BENTOML_ENV)
+    return {bento["tag"]: bento for bento in _json_loads(list_result)}
+
+
+@functools.cache
+def _yaml_loader():
+    import yaml
+
+    if yaml.__with_libyaml__:
+        return yaml.CSafeLoader
+    warnings.warn("libyaml is not available, parsing YAML in pure Python")
+    return yaml.SafeLoader
+
+
+def _get_bento_info(tag, refresh=False):
+    # cached entries went through JSON: datetimes and non-str keys come back
+    # as str, unlike a fresh `bentoml get`
+    bento_info_cache = _load_bento_info_cache()
+    if not refresh and tag in bento_info_cache:
+        return bento_info_cache[tag]
+
+    import yaml
 
-def _get_bento_info(tag):
     cmd = ["bentoml", "get", tag]
     print(f"\n$ {' '.join(cmd)}")
-    get_result = subprocess.check_output(
+    with subprocess.Popen(
         cmd,
-        env=dict(os.environ, BENTOML_HOME=BENTOML_HOME),
-    )
-    get_result = "\n".join(
-        [line.split("!!")[0] for line in get_result.decode().splitlines()]
-    )
-    bento_info = yaml.safe_load(get_result)
+        stdout=subprocess.PIPE,
+        env=BENTOML_ENV,
+    ) as proc:
+        # strip the YAML tags bentoml emits for python objects
+        get_result = b"\n".join(
+            line.rstrip(b"\n").partition(b"!!")[0] for line in proc.stdout
+        )
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    bento_info = yaml.load(get_result, Loader=_yaml_loader())
+    bento_info_cache[tag] = bento_info
+    _dump_json_atomic(BENTO_INFO_CACHE_FILE, bento_info_cache)
     return bento_info
 
 
@@ -148,7 +254,7 @@ def _build_bento(bento_project_dir, _, tag):
     build_result = subprocess.check_output(
         cmd,
         cwd=bento_project_dir,
-        env=dict(os.environ, BENTOML_HOME=BENTOML_HOME),
+        env=BENTOML_ENV,
     )
     tag = build_result.decode().strip()
     if tag.startswith("__tag__:"):
@@ -157,15 +263,39 @@ def _build_bento(bento_project_dir, _, tag):
 
 
 def _resolve_git_package(package):
-    match = REG_GITPACKAGE.match(package)
+    match = REG_GITPACKAGE.fullmatch(package)
     if not match:
         raise ValueError(f"Invalid git package: {package}")
-    repo_url, branch, subdirectory = match.groups()
-    parsed = urlparse(repo_url)
+    parts = match.groupdict()
+    return parts["repo"], parts["branch"], parts["subdirectory"]
 
-    path_parts = [parsed.netloc] + parsed.path.split("/")
 
-    return repo_url, branch, subdirectory, path_parts
+def _ensure_repo(repo, branch, repo_dir, refresh=False):
+    if not (repo_dir / ".git").exists():
+        repo_dir.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            cmd = [
+                "git",
+                "clone",
+                "--depth=1",
+                "--branch",
+                branch,
+                "--single-branch",
+                repo,
+                str(repo_dir),
+            ]
+            print(f"\n$ {' '.join(cmd)}")
+            subprocess.run(cmd, check=True)
+        except:
+            shutil.rmtree(repo_dir, ignore_errors=True)
+            raise
+    elif refresh:
+        for cmd in [
+            ["git", "-C", str(repo_dir), "fetch", "--depth=1", "origin", branch],
+            ["git", "-C", str(repo_dir), "reset", "--hard", "FETCH_HEAD"],
+        ]:
+            print(f"\n$ {' '.join(cmd)}")
+            subprocess.run(cmd, check=True)
 
 
 def _get_it_card(spec):
@@ -192,112 +322,77 @@ def _get_it_card(spec):
 
 
 def _ensure_aws_security_group(group_name="cllama-http-default"):
+    from botocore.exceptions import ClientError
+
+    ec2 = _ec2_client()
     try:
-        existing_groups = subprocess.check_output(
-            [
-                "aws",
-                "ec2",
-                "describe-security-groups",
-                "--filters",
-                f"Name=group-name,Values={group_name}",
-            ]
+        existing_groups = ec2.describe_security_groups(
+            Filters=[{"Name": "group-name", "Values": [group_name]}]
         )
-        existing_groups = json.loads(existing_groups)
         if existing_groups["SecurityGroups"]:
             return existing_groups["SecurityGroups"][0]["GroupId"]
 
-        result = subprocess.check_output(
-            [
-                "aws",
-                "ec2",
-                "create-security-group",
-                "--group-name",
-                group_name,
-                "--description",
-                "Default VPC security group for cllama services",
-            ]
+        result = ec2.create_security_group(
+            GroupName=group_name,
+            Description="Default VPC security group for cllama services",
         )
-        result = json.loads(result)
         security_group_id = result["GroupId"]
 
-        subprocess.check_call(
-            [
-                "aws",
-                "ec2",
-                "authorize-security-group-ingress",
-                "--group-id",
-                security_group_id,
-                "--protocol",
-                "tcp",
-                "--port",
-                "80",
-                "--cidr",
-                "0.0.0.0/0",
-            ]
-        )
-        subprocess.check_call(
-            [
-                "aws",
-                "ec2",
-                "authorize-security-group-ingress",
-                "--group-id",
-                security_group_id,
-                "--protocol",
-                "tcp",
-                "--port",
-                "443",
-                "--cidr",
-                "0.0.0.0/0",
-            ]
-        )
-        subprocess.check_call(
-            [
-                "aws",
-                "ec2",
-                "authorize-security-group-ingress",
-                "--group-id",
-                security_group_id,
-                "--protocol",
-                "tcp",
-                "--port",
-                "22",
-                "--cidr",
-                "0.0.0.0/0",
-            ]
+        ec2.authorize_security_group_ingress(
+            GroupId=security_group_id,
+            IpPermissions=[
+                {
+                    "IpProtocol": "tcp",
+                    "FromPort": port,
+                    "ToPort": port,
+                    "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
+                }
+                for port in (22, 80, 443)
+            ],
         )
         return security_group_id
-    except subprocess.CalledProcessError as e:
+    except ClientError as e:
         raise RuntimeError(f"Failed to create security group: {e}")
 
 
 @app.command()
-def run(model: str, tag: str = "latest", force_rebuild: bool = False):
+def run(
+    model: str,
+    tag: str = "latest",
+    force_rebuild: bool = False,
+    purge: bool = False,
+    refresh: bool = False,
+):
+    import questionary
+    from botocore.exceptions import ClientError, NoCredentialsError, NoRegionError
+
     if tag == "latest":
         tag = next(iter(MODEL_INFOS[model].keys()))
 
     package = MODEL_INFOS[model][tag]
-    repo, branch, subdirectory, path_parts = _resolve_git_package(package)
-    try:
-        bento_info = _get_bento_info(f"{model}:{tag}")
-    except subprocess.CalledProcessError:
-        repo_dir = REPO_DIR.joinpath(*path_parts)
+    repo, branch, subdirectory = _resolve_git_package(package)
+    bento_info = None
+    if not purge:
+        try:
+            bento_info = _get_bento_info(
+                f"{model}:{tag}",
+                refresh=force_rebuild or refresh,
+            )
+        except subprocess.CalledProcessError:
+            pass
+
+    if bento_info is None:
+        repo_key = hashlib.sha256(f"{repo}@{branch}".encode()).hexdigest()[:16]
+        repo_dir = REPO_DIR / repo_key
 
-        if force_rebuild:
+        if purge:
             shutil.rmtree(repo_dir, ignore_errors=True)
 
-        if not repo_dir.exists():
-            repo_dir.parent.mkdir(parents=True, exist_ok=True)
-            try:
-                cmd = ["git", "clone", "--branch", branch, repo, str(repo_dir)]
-                print(f"\n$ {' '.join(cmd)}")
-                subprocess.run(cmd, check=True)
-            except:
-                shutil.rmtree(repo_dir, ignore_errors=True)
-                raise
+        _ensure_repo(repo, branch, repo_dir, refresh=force_rebuild)
 
         bento_project_dir = repo_dir / subdirectory
         bento, tag = _build_bento(bento_project_dir, model, tag)
-        bento_info = _get_bento_info(f"{bento}:{tag}")
+        bento_info = _get_bento_info(f"{bento}:{tag}", refresh=True)
 
     if len(bento_info["services"]) != 1:
         raise ValueError("Only support one service currently")
@@ -308,17 +403,6 @@ def run(model: str, tag: str = "latest", force_rebuild: bool = False):
     ).ask()
 
     if cloud_provider == "aws":
-        try:
-            cmd = ["aws", "ec2", "describe-instance-types"]
-            print(f"\n$ {' '.join(cmd)}")
-            _instance_types = subprocess.check_output(cmd, text=True)
-        except subprocess.CalledProcessError:
-            raise
-            # print(e)
-            # _cli_install_aws()
-        available_it_infos = json.loads(_instance_types)["InstanceTypes"]
-        # pyaml.p(available_it_infos)
-
         service = bento_info["services"][0]
         if "config" not in service or "resources" not in service["config"]:
             raise ValueError("Service config is missing")
@@ -326,6 +410,13 @@ def run(model: str, tag: str = "latest", force_rebuild: bool = False):
             gpu_count = service["config"]["resources"]["gpu"]
             gpu_type = service["config"]["resources"].get("gpu_type")
             gpu_memory = service["config"]["resources"].get("gpu_memory")
+            try:
+                available_it_infos = _load_cached_instance_types(
+                    _ec2_client().meta.region_name,
+                    refresh=refresh,
+                )
+            except (ClientError, NoCredentialsError, NoRegionError) as e:
+                raise RuntimeError(f"Failed to list instance types: {e}")
             supported_its = _filter_instance_types(
                 available_it_infos,
                 gpu_count,
@@ -342,35 +433,38 @@ def run(model: str, tag: str = "latest", force_rebuild: bool = False):
                     for it_info in supported_its
                 ],
             ).ask()
-            security_group_id = _ensure_aws_security_group()
+            if it is None:
+                return
+
             AMI = "ami-02623cf022763d4a1"
+            KEY_NAME = "jiang"
+            confirmed = questionary.confirm(
+                f"Launch a {it} instance (ami: {AMI}, key pair: {KEY_NAME})?"
+                " This will incur EC2 charges.",
+                default=False,
+            ).ask()
+            if not confirmed:
+                print("Aborted")
+                return
 
-            init_script_file = CACHE_DIR / f"init_script_{str(uuid.uuid4())[:8]}.sh"
-            with open(init_script_file, "w") as f:
-                f.write(
-                    INIT_SCRIPT_TEMPLATE.format(
-                        repo=repo,
-                        subdirectory=subdirectory,
-                    )
+            security_group_id = _ensure_aws_security_group()
+            user_data = INIT_SCRIPT_TEMPLATE.format(
+                repo=repo,
+                subdirectory=subdirectory,
+            )
+            try:
+                result = _ec2_client().run_instances(
+                    ImageId=AMI,
+                    InstanceType=it,
+                    SecurityGroupIds=[security_group_id],
+                    UserData=user_data,
+                    KeyName=KEY_NAME,
+                    MinCount=1,
+                    MaxCount=1,
                 )
-            cmd = [
-                "aws",
-                "ec2",
-                "run-instances",
-                "--image-id",
-                AMI,
-                "--instance-type",
-                it,
-                "--security-group-ids",
-                security_group_id,
-                "--user-data",
-                f"file://{init_script_file}",
-                "--key-name",
-                "jiang",
-                "--count",
-                "1",
-            ]
-            print(f"\n$ {' '.join(cmd)}")
+            except (ClientError, NoCredentialsError, NoRegionError) as e:
+                raise RuntimeError(f"Failed to launch instance: {e}")
+            print(f"\nLaunched instance {result['Instances'][0]['InstanceId']}")
 
         else:
             raise ValueError("GPU is required for now")
@@ -386,7 +480,26 @@ pip3 install -r requirements.txt
 
 @app.command()
 def list():
-    pyaml.p({"models": {k: tuple(v.keys()) for k, v in MODEL_INFOS.items()}})
+    import pyaml
+
+    try:
+        bentos = _list_all_bentos()
+    except (OSError, subprocess.CalledProcessError, json.JSONDecodeError):
+        bentos = None
+
+    def _status(model, tag):
+        if bentos is None:
+            return "unknown"
+        return "installed" if f"{model}:{tag}" in bentos else "not installed"
+
+    pyaml.p(
+        {
+            "models": {
+                model: {tag: _status(model, tag) for tag in tags}
+                for model, tags in MODEL_INFOS.items()
+            }
+        }
+    )
 
 
 if __name__ == "__main__":